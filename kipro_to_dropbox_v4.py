@@ -14,9 +14,13 @@ import os
 import json
 import time
 import logging
-from datetime import datetime
+import re
+from datetime import datetime, timedelta
 from pathlib import Path
 import schedule
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib.parse import quote
 
 # Configuration
@@ -28,6 +32,28 @@ LOCAL_TEMP_DIR = "./temp_downloads"  # Local temporary storage
 LOG_FILE = "kipro_automation.log"
 TOKEN_FILE = "dropbox_token.json"  # File to store Dropbox tokens
 
+# Media format settings
+# A unit is only formatted when every clip on it was uploaded and verified, so
+# Ki Pro 1 and 2 (never downloaded from) are never formatted.
+FORMAT_POLL_INTERVAL = 5  # Seconds between media state polls while formatting
+FORMAT_TIMEOUT = 600  # Give up waiting on a unit's format after this many seconds
+FORMAT_MIN_AVAILABLE = 99  # Media available (%) a freshly formatted drive reports
+
+# Proxy settings (requires ffmpeg on PATH)
+PROXY_ENABLED = False  # Transcode low-res proxies alongside the original upload
+PROXY_FOLDER_SUFFIX = "_proxies"  # Proxies go to a sibling of each upload folder
+PROXY_WORKERS = os.cpu_count() or 1  # Max parallel ffmpeg processes (capped at the clip count)
+PROXY_HEIGHT = 540  # Proxy frame height in pixels
+PROXY_CONTACT_SHEET_TILES = (4, 3)  # Contact sheet grid (columns, rows), spread across the whole clip
+PROXY_CONTACT_SHEET_INTERVAL = 300  # Seconds between frames if the clip length can't be read (covers the first hour)
+PROXY_TIMEOUT = 3 * 60 * 60  # Kill an ffmpeg run that takes longer than this (seconds)
+
+# Dropbox retention settings
+RETENTION_WEEKS = 8  # Delete backup folders older than this
+RETENTION_DRY_RUN = True  # Only log what retention would change; set False to apply
+RETENTION_BATCH_SIZE = 1000  # Entries per move/delete batch call (Dropbox maximum)
+RETENTION_BATCH_POLL_INTERVAL = 2  # Seconds between batch job status checks
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -131,6 +157,118 @@ def test_dropbox_connection(access_token):
         logging.error(f"Dropbox connection test failed: {e}")
         return False
 
+def probe_duration(source_path):
+    """Clip length in seconds from ffprobe, or None if it can't be read"""
+    try:
+        result = subprocess.run([
+            "ffprobe", "-v", "error", "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1", str(source_path)
+        ], check=True, capture_output=True, text=True, timeout=60)
+        return float(result.stdout.strip())
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+
+def transcode_proxy(source_path, output_dir, threads):
+    """Create a low-res proxy and contact sheet for a clip with ffmpeg (runs in a worker process)"""
+    source = Path(source_path)
+    proxy_path = Path(output_dir) / f"{source.stem}_proxy.mp4"
+    sheet_path = Path(output_dir) / f"{source.stem}_contact.jpg"
+
+    # Space the contact sheet frames evenly so the whole service is covered
+    columns, rows = PROXY_CONTACT_SHEET_TILES
+    duration = probe_duration(source)
+    interval = duration / (columns * rows) if duration else PROXY_CONTACT_SHEET_INTERVAL
+
+    # Decode the master once and split it: an H.264/AAC proxy small enough to
+    # scrub over a normal connection, plus the contact sheet frames tiled into
+    # a single image
+    filters = (
+        f"[0:v]split=2[proxy][sheet];"
+        f"[proxy]scale=-2:{PROXY_HEIGHT}[proxy_out];"
+        f"[sheet]fps=1/{interval:.3f},scale=320:-2,tile={columns}x{rows}[sheet_out]"
+    )
+    subprocess.run([
+        "ffmpeg", "-y", "-loglevel", "error", "-threads", str(threads),
+        "-i", str(source),
+        "-filter_complex", filters, "-filter_complex_threads", str(threads),
+        "-map", "[proxy_out]", "-map", "0:a:0?",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "28", "-threads", str(threads),
+        "-c:a", "aac", "-b:a", "96k",
+        str(proxy_path),
+        "-map", "[sheet_out]", "-frames:v", "1",
+        str(sheet_path)
+    ], check=True, capture_output=True, timeout=PROXY_TIMEOUT)
+
+    return [proxy_path, sheet_path]
+
+def clip_base_name(name):
+    """Clip name without its .mov extension, so listings and uploads compare equal"""
+    return name[:-4] if name.lower().endswith(".mov") else name
+
+class ProxyStage:
+    """Transcodes proxies in a process pool and uploads each one as soon as it is ready"""
+
+    def __init__(self, automation, dropbox_folder, clip_count):
+        self.automation = automation
+        self.dropbox_folder = dropbox_folder
+        # Separate client so proxy uploads don't share a session with the original upload
+        self.dbx = dropbox.Dropbox(automation.access_token)
+        # Only as many workers as there are clips, sharing the cores between them
+        workers = max(1, min(PROXY_WORKERS, clip_count))
+        self.threads = max(1, (os.cpu_count() or 1) // workers)
+        self.transcoder = ProcessPoolExecutor(max_workers=workers)
+        self.uploader = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.aborted = False
+        logging.info(f"Proxy stage started with {workers} workers x {self.threads} threads -> {dropbox_folder}")
+
+    def submit(self, local_file):
+        """Queue a downloaded clip for proxy generation and upload"""
+        transcode = self.transcoder.submit(transcode_proxy, str(local_file), str(local_file.parent), self.threads)
+        self.pending.append(self.uploader.submit(self._upload_when_ready, local_file.name, transcode))
+
+    def _upload_when_ready(self, filename, transcode):
+        try:
+            outputs = transcode.result()
+        except subprocess.CalledProcessError as e:
+            logging.error(f"ffmpeg failed for {filename}: {e.stderr.decode(errors='replace').strip()}")
+            return 0
+        except subprocess.TimeoutExpired:
+            logging.error(f"ffmpeg timed out after {PROXY_TIMEOUT}s for {filename}")
+            return 0
+        except Exception as e:
+            logging.error(f"Proxy generation failed for {filename}: {e}")
+            return 0
+
+        if self.aborted:
+            return 0
+
+        logging.info(f"Proxies ready for {filename}")
+        uploaded = 0
+        for path in outputs:
+            if self.automation.upload_to_dropbox(path, f"{self.dropbox_folder}/{path.name}", dbx=self.dbx):
+                uploaded += 1
+        return uploaded
+
+    def finish(self):
+        """Wait for all queued proxies to upload and shut the pools down"""
+        uploaded = sum(future.result() for future in self.pending)
+        self.uploader.shutdown()
+        self.transcoder.shutdown()
+        logging.info(f"Uploaded {uploaded}/{len(self.pending) * 2} proxy files")
+        return uploaded
+
+    def abort(self):
+        """Cancel queued proxies without waiting, so a failed run doesn't hold up the scheduler
+
+        An ffmpeg run already in progress finishes (or hits PROXY_TIMEOUT) in the
+        background, but its output is not uploaded.
+        """
+        self.aborted = True
+        self.uploader.shutdown(wait=False, cancel_futures=True)
+        self.transcoder.shutdown(wait=False, cancel_futures=True)
+        logging.warning("Proxy stage aborted")
+
 class KiProAutomation:
     def __init__(self):
         self.kipro_base_url = f"http://{KIPRO_3_IP}"
@@ -145,22 +283,24 @@ class KiProAutomation:
             raise ValueError("Dropbox connection test failed")
         
         # Initialize Dropbox client
+        self.access_token = access_token
         self.dbx = dropbox.Dropbox(access_token)
         self.temp_dir = Path(LOCAL_TEMP_DIR)
         self.temp_dir.mkdir(exist_ok=True)
         
         logging.info("KiProAutomation initialized successfully")
     
-    def set_kipro_data_mode(self, enable=True):
-        """Set Ki Pro to Data-LAN mode for file transfers"""
+    def set_kipro_data_mode(self, enable=True, kipro_ip=None):
+        """Set Ki Pro to Data-LAN mode for file transfers (defaults to Ki Pro 3)"""
         mode = 1 if enable else 0  # 1 = Data-LAN, 0 = Record-Play
-        url = f"{self.kipro_base_url}/config?action=set&paramid=eParamID_MediaState&value={mode}"
-        
+        base_url = f"http://{kipro_ip}" if kipro_ip is not None else self.kipro_base_url
+        url = f"{base_url}/config?action=set&paramid=eParamID_MediaState&value={mode}"
+
         try:
             response = requests.get(url, timeout=10)
             response.raise_for_status()
             mode_name = "Data-LAN" if enable else "Record-Play"
-            logging.info(f"Ki Pro set to {mode_name} mode")
+            logging.info(f"Ki Pro {kipro_ip or KIPRO_3_IP} set to {mode_name} mode")
             return True
         except requests.exceptions.RequestException as e:
             logging.error(f"Failed to set Ki Pro mode: {e}")
@@ -182,10 +322,12 @@ class KiProAutomation:
             transport_state = _get_json("eParamID_TransportState")
             media_state     = _get_json("eParamID_MediaState")
             clip_name       = _get_json("eParamID_ClipName")
+            media_available = _get_json("eParamID_CurrentMediaAvailable")
             return {
                 "transport_state": transport_state,
                 "media_state": media_state,
-                "clip_name": clip_name
+                "clip_name": clip_name,
+                "media_available": media_available
             }
         except Exception as e:
             logging.error(f"Failed to get status from Ki Pro {kipro_ip}: {e}")
@@ -424,6 +566,24 @@ class KiProAutomation:
         logging.info(f"File {filename} (with or without .mov) not found on Ki Pro")
         return None
     
+    def list_kipro_clips(self, kipro_ip):
+        """List the clip names on a Ki Pro's media, or None if the unit can't be read"""
+        try:
+            response = requests.get(f"http://{kipro_ip}/clips", params={"action": "get_clips"}, timeout=10)
+            response.raise_for_status()
+            # Older firmware returns JavaScript-style objects rather than strict JSON,
+            # so accept either quote style but refuse anything we can't fully read
+            keys = re.findall(r'\bclipname\b', response.text)
+            clips = [m[1] for m in re.findall(r'\bclipname["\']?\s*:\s*(["\'])(.+?)\1', response.text)]
+            if not keys or len(clips) != len(keys):
+                logging.error(f"Unrecognised clip listing from Ki Pro {kipro_ip}: {response.text[:200]!r}")
+                return None
+            logging.info(f"Ki Pro {kipro_ip} has {len(clips)} clips: {clips}")
+            return clips
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to list clips on Ki Pro {kipro_ip}: {e}")
+            return None
+
     def download_file_from_kipro(self, filename):
         """Download a single file from Ki Pro"""
         local_path = self.temp_dir / filename
@@ -458,8 +618,9 @@ class KiProAutomation:
             logging.error(f"Failed to download {filename}: {e}")
             return None
     
-    def upload_to_dropbox(self, local_file_path, dropbox_path):
-        """Upload file to Dropbox with retry logic"""
+    def upload_to_dropbox(self, local_file_path, dropbox_path, dbx=None):
+        """Upload file to Dropbox with retry logic (dbx overrides the shared client)"""
+        dbx = dbx or self.dbx
         max_retries = 3
         retry_delay = 5
         
@@ -470,11 +631,11 @@ class KiProAutomation:
                     logging.info(f"Uploading {local_file_path.name} ({file_size / (1024*1024):.1f} MB) to Dropbox... (Attempt {attempt + 1})")
                     
                     if file_size <= 150 * 1024 * 1024:  # Files smaller than 150MB
-                        self.dbx.files_upload(f.read(), dropbox_path, mode=dropbox.files.WriteMode.overwrite)
+                        dbx.files_upload(f.read(), dropbox_path, mode=dropbox.files.WriteMode.overwrite)
                     else:
                         # Use upload session for large files
                         f.seek(0)  # Reset file pointer
-                        self._upload_large_file(f, dropbox_path, file_size)
+                        self._upload_large_file(f, dropbox_path, file_size, dbx)
                     
                     logging.info(f"✓ Uploaded {local_file_path.name} to Dropbox: {dropbox_path}")
                     return True
@@ -490,11 +651,12 @@ class KiProAutomation:
         
         return False
     
-    def _upload_large_file(self, file_obj, dropbox_path, file_size):
+    def _upload_large_file(self, file_obj, dropbox_path, file_size, dbx=None):
         """Upload large files using Dropbox upload session"""
+        dbx = dbx or self.dbx
         CHUNK_SIZE = 4 * 1024 * 1024  # 4MB chunks
         
-        session_start_result = self.dbx.files_upload_session_start(file_obj.read(CHUNK_SIZE))
+        session_start_result = dbx.files_upload_session_start(file_obj.read(CHUNK_SIZE))
         cursor = dropbox.files.UploadSessionCursor(
             session_id=session_start_result.session_id,
             offset=file_obj.tell()
@@ -504,15 +666,39 @@ class KiProAutomation:
             if (file_size - file_obj.tell()) <= CHUNK_SIZE:
                 # Final chunk
                 commit = dropbox.files.CommitInfo(path=dropbox_path, mode=dropbox.files.WriteMode.overwrite)
-                self.dbx.files_upload_session_finish(file_obj.read(CHUNK_SIZE), cursor, commit)
+                dbx.files_upload_session_finish(file_obj.read(CHUNK_SIZE), cursor, commit)
             else:
-                self.dbx.files_upload_session_append_v2(file_obj.read(CHUNK_SIZE), cursor)
+                dbx.files_upload_session_append_v2(file_obj.read(CHUNK_SIZE), cursor)
                 cursor.offset = file_obj.tell()
                 
                 # Log progress for large files
                 progress = (file_obj.tell() / file_size) * 100
                 logging.info(f"Upload progress: {progress:.1f}%")
-    
+
+    def verify_dropbox_upload(self, local_file_path, dropbox_path):
+        """Confirm an uploaded clip exists in Dropbox with the same size as the local copy"""
+        try:
+            local_size = os.path.getsize(local_file_path)
+            metadata = self.dbx.files_get_metadata(dropbox_path)
+            remote_size = getattr(metadata, 'size', None)
+            if remote_size == local_size:
+                logging.info(f"✓ Verified {dropbox_path} ({remote_size} bytes)")
+                return True
+            logging.error(f"✗ Size mismatch for {dropbox_path}: local {local_size}, Dropbox {remote_size}")
+            return False
+        except Exception as e:
+            logging.error(f"Failed to verify {dropbox_path}: {e}")
+            return False
+
+    def start_proxy_stage(self, dropbox_backup_folder, clip_count):
+        """Start the proxy stage for an upload folder, or return None if disabled or unavailable"""
+        if not PROXY_ENABLED:
+            return None
+        if not shutil.which("ffmpeg"):
+            logging.warning("ffmpeg not found on PATH, skipping proxy generation")
+            return None
+        return ProxyStage(self, f"{dropbox_backup_folder}{PROXY_FOLDER_SUFFIX}", clip_count)
+
     def cleanup_local_files(self):
         """Remove temporary downloaded files"""
         try:
@@ -523,40 +709,322 @@ class KiProAutomation:
         except Exception as e:
             logging.error(f"Error cleaning up local files: {e}")
     
-    def format_kipro_media(self):
-        """Format/wipe the Ki Pro media"""
-        kipro_ips = [KIPRO_1_IP, KIPRO_2_IP, KIPRO_3_IP]
-        
-        logging.info("=== Starting media format on all Ki Pros ===")
-        
-        for i, ip in enumerate(kipro_ips, 1):
+    def get_media_available(self, kipro_ip):
+        """Return a Ki Pro's free media (%) as a float, or None if the unit doesn't report it"""
+        status = self.get_kipro_status(kipro_ip)
+        try:
+            return float(status['media_available'])
+        except (TypeError, ValueError):
+            return None
+
+    def wait_for_format(self, kipro_ip, unit, available_before):
+        """Poll a Ki Pro's media state until its format finishes or FORMAT_TIMEOUT expires
+
+        A high free-space reading alone doesn't prove anything (a lightly used drive is
+        already near empty), so the format only counts as finished once the unit has
+        either gone busy and come back, or its free space has risen above available_before.
+        """
+        start = time.time()
+        last_available = available_before
+        went_busy = False
+
+        while time.time() - start < FORMAT_TIMEOUT:
+            time.sleep(FORMAT_POLL_INTERVAL)
+
+            # The unit stops answering (or reports "unknown") while the format runs
+            available = self.get_media_available(kipro_ip)
+            if available is None:
+                went_busy = True
+                logging.info(f"Ki Pro {unit} ({kipro_ip}) formatting... ({time.time() - start:.0f}s)")
+                continue
+
+            if available != last_available:
+                logging.info(f"Ki Pro {unit} ({kipro_ip}) format progress: {available:.0f}% media available")
+                last_available = available
+
+            rose = available_before is not None and available > available_before
+            if available >= FORMAT_MIN_AVAILABLE and (went_busy or rose):
+                return True
+
+        logging.error(f"Timed out after {FORMAT_TIMEOUT}s waiting for Ki Pro {unit} ({kipro_ip}) to finish formatting")
+        return False
+
+    def format_kipro_unit(self, unit, kipro_ip, verified_clips):
+        """Format one Ki Pro if every clip on it is in verified_clips, then return it to Record-Play mode"""
+        result = {"ip": kipro_ip, "status": "skipped", "elapsed": 0.0}
+        start = time.time()
+
+        # Nothing backed up from this unit means nothing to free, so don't risk an erase
+        if not verified_clips:
+            logging.info(f"Ki Pro {unit} ({kipro_ip}) has no verified backup, skipping format")
+            self.set_kipro_data_mode(False, kipro_ip)
+            return result
+
+        # The format erases the whole drive, so check what is actually on it
+        clips = self.list_kipro_clips(kipro_ip)
+        unverified = [c for c in clips or [] if clip_base_name(c) not in verified_clips]
+
+        if clips is None:
+            logging.warning(f"Ki Pro {unit} ({kipro_ip}) clips could not be listed, skipping format")
+        elif not clips:
+            # An erase of an empty drive can't be confirmed by wait_for_format
+            logging.info(f"Ki Pro {unit} ({kipro_ip}) media is already empty, skipping format")
+        elif unverified:
+            logging.warning(f"Ki Pro {unit} ({kipro_ip}) has clips without a verified backup, "
+                            f"skipping format: {unverified}")
+        else:
             try:
                 # First set format type to HSF+ (you can change to ExFat by using value=1)
-                format_url = f"http://{ip}/config?action=set&paramid=eParamID_FileSystemFormat&value=0"
+                format_url = f"http://{kipro_ip}/config?action=set&paramid=eParamID_FileSystemFormat&value=0"
                 response = requests.get(format_url, timeout=10)
                 response.raise_for_status()
-                
+
                 # Wait a moment
                 time.sleep(2)
-                
+
+                # Note free space first so we can tell when the erase actually happened
+                available_before = self.get_media_available(kipro_ip)
+                logging.info(f"Ki Pro {unit} ({kipro_ip}) media available before format: {available_before}%")
+
                 # Execute the format command
-                erase_url = f"http://{ip}/config?action=set&paramid=eParamID_StorageCommand&value=4"
+                erase_url = f"http://{kipro_ip}/config?action=set&paramid=eParamID_StorageCommand&value=4"
                 response = requests.get(erase_url, timeout=10)
                 response.raise_for_status()
-                
-                logging.info(f"✓ Ki Pro {i} ({ip}) media format initiated")
-                
+
+                logging.info(f"Ki Pro {unit} ({kipro_ip}) media format initiated")
+
+                if self.wait_for_format(kipro_ip, unit, available_before):
+                    result["status"] = "formatted"
+                    logging.info(f"✓ Ki Pro {unit} ({kipro_ip}) media format completed")
+                else:
+                    result["status"] = "timeout"
+
             except requests.exceptions.RequestException as e:
-                logging.error(f"Failed to format Ki Pro {i} media at {ip}: {e}")
-                continue
-        
-        logging.info("=== Media format completed on all Ki Pros ===")
-        return True
+                logging.error(f"Failed to format Ki Pro {unit} media at {kipro_ip}: {e}")
+                result["status"] = "failed"
+
+        # Hand the unit back for recording as soon as it is done
+        self.set_kipro_data_mode(False, kipro_ip)
+        result["elapsed"] = time.time() - start
+        return result
+
+    def format_kipro_media(self, verified_clips):
+        """Format/wipe Ki Pro media in parallel, only on units whose clips all verified
+
+        verified_clips maps Ki Pro number (1-3) to the clip names from that unit that
+        were uploaded and verified in Dropbox. Returns a dict of per-unit results with status formatted/skipped/failed/timeout.
+        """
+        kipro_ips = [KIPRO_1_IP, KIPRO_2_IP, KIPRO_3_IP]
+
+        logging.info("=== Starting media format stage on all Ki Pros ===")
+
+        with ThreadPoolExecutor(max_workers=len(kipro_ips)) as executor:
+            futures = {
+                i: executor.submit(self.format_kipro_unit, i, ip, verified_clips.get(i, set()))
+                for i, ip in enumerate(kipro_ips, 1)
+            }
+            results = {i: future.result() for i, future in futures.items()}
+
+        for i, result in results.items():
+            logging.info(f"Ki Pro {i} ({result['ip']}): {result['status']} ({result['elapsed']:.0f}s)")
+
+        formatted = sum(1 for r in results.values() if r["status"] == "formatted")
+        logging.info(f"Media format summary: {formatted}/{len(kipro_ips)} formatted")
+        return results
     
+    def list_dropbox_tree(self, path):
+        """List every entry under a Dropbox folder, paging with files_list_folder/continue"""
+        result = self.dbx.files_list_folder(path, recursive=True)
+        entries = list(result.entries)
+        while result.has_more:
+            result = self.dbx.files_list_folder_continue(result.cursor)
+            entries.extend(result.entries)
+        logging.info(f"Listed {len(entries)} entries under {path}")
+        return entries
+
+    def plan_retention(self):
+        """Work out which backup folders to delete and which to merge into one folder per date"""
+        cutoff = datetime.today().date() - timedelta(weeks=RETENTION_WEEKS)
+        pattern = re.compile(rf"^(?:upload_)?(\d{{8}})(?:_\d{{6}})?({re.escape(PROXY_FOLDER_SUFFIX)})?$")
+        root = DROPBOX_FOLDER.rstrip('/')
+
+        # Group the top-level backup folders and their files
+        folders = {}
+        invalid = set()
+        for entry in self.list_dropbox_tree(root):
+            relative = entry.path_display[len(root) + 1:]
+            top, _, rest = relative.partition('/')
+            match = pattern.match(top)
+            if not match or top in invalid:
+                continue
+            if top not in folders:
+                try:
+                    folder_date = datetime.strptime(match.group(1), "%Y%m%d").date()
+                except ValueError:
+                    logging.warning(f"Skipping {root}/{top}: {match.group(1)} is not a valid date")
+                    invalid.add(top)
+                    continue
+                folders[top] = {"date": match.group(1), "day": folder_date,
+                                "suffix": match.group(2) or "", "files": {}}
+            folder = folders[top]
+            if rest and isinstance(entry, dropbox.files.FileMetadata):
+                folder["files"][rest] = (entry.size, entry.content_hash)
+
+        # Files already in (or headed for) each date folder, keyed the way Dropbox
+        # compares paths, so a rerun's copy of the same clip isn't kept twice
+        targets = {}
+        for name, folder in folders.items():
+            if name == f"{folder['date']}{folder['suffix']}":
+                targets[name] = {relative.lower(): fingerprint for relative, fingerprint in folder["files"].items()}
+
+        plan = {"delete": [], "move_folders": [], "move": [], "duplicates": [], "merged": []}
+        for name, folder in sorted(folders.items()):
+            if folder["day"] < cutoff:
+                plan["delete"].append(f"{root}/{name}")
+                continue
+
+            # Consolidate every run from the same date into a single YYYYMMDD folder
+            target = f"{folder['date']}{folder['suffix']}"
+            if name == target:
+                continue
+
+            # Nothing at the target yet, so a single folder move does the job
+            if target not in targets:
+                plan["move_folders"].append((f"{root}/{name}", f"{root}/{target}"))
+                targets[target] = {relative.lower(): fingerprint for relative, fingerprint in folder["files"].items()}
+                continue
+
+            incoming = targets[target]
+            for relative, fingerprint in sorted(folder["files"].items()):
+                move = (f"{root}/{name}/{relative}", f"{root}/{target}/{relative}")
+                if incoming.get(relative.lower()) == fingerprint:
+                    # Identical copy already there; it goes with its run folder
+                    plan["duplicates"].append(move)
+                    continue
+                # Same name with different content is moved and autorenamed
+                incoming.setdefault(relative.lower(), fingerprint)
+                plan["move"].append(move)
+            plan["merged"].append(f"{root}/{name}")
+
+        return plan
+
+    def _run_batch_job(self, launch, check, description):
+        """Wait for a Dropbox batch job to finish and return how many entries succeeded"""
+        if launch.is_async_job_id():
+            job_id = launch.get_async_job_id()
+            status = check(job_id)
+            while status.is_in_progress():
+                time.sleep(RETENTION_BATCH_POLL_INTERVAL)
+                status = check(job_id)
+            if not status.is_complete():
+                logging.error(f"{description} batch failed: {status}")
+                return 0
+            result = status.get_complete()
+        elif launch.is_complete():
+            result = launch.get_complete()
+        else:
+            logging.error(f"{description} batch failed: {launch}")
+            return 0
+
+        succeeded = sum(1 for entry in result.entries if entry.is_success())
+        if succeeded < len(result.entries):
+            logging.error(f"{description} batch: {len(result.entries) - succeeded}/{len(result.entries)} entries failed")
+        return succeeded
+
+    def move_dropbox_batch(self, moves, autorename=True):
+        """Move files or folders with files_move_batch_v2, RETENTION_BATCH_SIZE entries per call"""
+        moved = 0
+        for start in range(0, len(moves), RETENTION_BATCH_SIZE):
+            entries = [
+                dropbox.files.RelocationPath(from_path=src, to_path=dst)
+                for src, dst in moves[start:start + RETENTION_BATCH_SIZE]
+            ]
+            launch = self.dbx.files_move_batch_v2(entries, autorename=autorename)
+            moved += self._run_batch_job(launch, self.dbx.files_move_batch_check_v2, "Move")
+        return moved
+
+    def delete_dropbox_batch(self, paths):
+        """Delete files or folders with files_delete_batch, RETENTION_BATCH_SIZE entries per call"""
+        deleted = 0
+        for start in range(0, len(paths), RETENTION_BATCH_SIZE):
+            entries = [dropbox.files.DeleteArg(path) for path in paths[start:start + RETENTION_BATCH_SIZE]]
+            launch = self.dbx.files_delete_batch(entries)
+            deleted += self._run_batch_job(launch, self.dbx.files_delete_batch_check, "Delete")
+        return deleted
+
+    def run_retention(self, dry_run=None):
+        """Delete backups older than RETENTION_WEEKS and merge the rest into one folder per date
+
+        With dry_run (default RETENTION_DRY_RUN) only the planned changes are logged.
+        Returns the plan.
+        """
+        dry_run = RETENTION_DRY_RUN if dry_run is None else dry_run
+        logging.info(f"=== Starting Dropbox retention ({'dry run' if dry_run else 'live'}, keep {RETENTION_WEEKS} weeks) ===")
+
+        try:
+            plan = self.plan_retention()
+        except Exception as e:
+            logging.error(f"Failed to list Dropbox backups: {e}")
+            return None
+
+        for path in plan["delete"]:
+            logging.info(f"Expired: {path}")
+        for source, target in plan["move_folders"]:
+            logging.info(f"Move folder: {source} -> {target}")
+        for source, target in plan["move"]:
+            logging.info(f"Move: {source} -> {target}")
+        for source, target in plan["duplicates"]:
+            logging.info(f"Duplicate of {target}: {source}")
+        for path in plan["merged"]:
+            logging.info(f"Remove after merge: {path}")
+        logging.info(f"Retention plan: delete {len(plan['delete'])} folders, "
+                     f"move {len(plan['move_folders'])} folders, "
+                     f"move {len(plan['move'])} files out of {len(plan['merged'])} folders, "
+                     f"drop {len(plan['duplicates'])} duplicates")
+
+        if dry_run:
+            logging.info("=== Dry run only, no changes made ===")
+            return plan
+
+        try:
+            if plan["delete"]:
+                deleted = self.delete_dropbox_batch(plan["delete"])
+                logging.info(f"Deleted {deleted}/{len(plan['delete'])} expired folders")
+
+            # Whole folders first, since later file moves and duplicate checks
+            # assume their contents are already in the date folder
+            if plan["move_folders"]:
+                # No autorename: if the date folder appeared since planning, fail
+                # the entry rather than quietly creating "YYYYMMDD (1)"
+                moved = self.move_dropbox_batch(plan["move_folders"], autorename=False)
+                logging.info(f"Moved {moved}/{len(plan['move_folders'])} folders")
+                if moved < len(plan["move_folders"]):
+                    logging.warning("Some folder moves failed, keeping the remaining upload folders")
+                    return plan
+
+            if plan["move"]:
+                moved = self.move_dropbox_batch(plan["move"])
+                logging.info(f"Moved {moved}/{len(plan['move'])} files")
+                if moved < len(plan["move"]):
+                    logging.warning("Some moves failed, keeping the original upload folders")
+                    return plan
+
+            # Only duplicates are left in the run folders, so remove them in one batch
+            if plan["merged"]:
+                removed = self.delete_dropbox_batch(plan["merged"])
+                logging.info(f"Removed {removed}/{len(plan['merged'])} merged folders")
+
+        except Exception as e:
+            logging.error(f"Retention failed with error: {e}")
+
+        logging.info("=== Dropbox retention completed ===")
+        return plan
+
     def run_weekly_upload(self):
         """Main upload routine - run this weekly"""
         logging.info("=== Starting weekly Ki Pro upload ===")
-        
+        proxy_stage = None
+
         try:
             # Step 1: Set Ki Pro to Data-LAN mode
             if not self.set_kipro_data_mode(True):
@@ -590,38 +1058,49 @@ class KiProAutomation:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             dropbox_backup_folder = f"{DROPBOX_FOLDER}/upload_{timestamp}"
             
-            # Step 4: Download and upload each existing file
+            # Step 4: Download and upload each existing file, transcoding
+            # proxies in the background while the original uploads
+            proxy_stage = self.start_proxy_stage(dropbox_backup_folder, len(existing_files))
             successful_uploads = 0
+            verified_uploads = 0
+            verified_names = set()
             for filename in existing_files:
                 local_file = self.download_file_from_kipro(filename)
                 if local_file:
+                    if proxy_stage:
+                        proxy_stage.submit(local_file)
                     dropbox_path = f"{dropbox_backup_folder}/{filename}"
                     if self.upload_to_dropbox(local_file, dropbox_path):
                         successful_uploads += 1
-            
-            logging.info(f"Successfully uploaded {successful_uploads}/{len(existing_files)} files")
-            
-            # Step 5: Clean up local temporary files
+                        if self.verify_dropbox_upload(local_file, dropbox_path):
+                            verified_uploads += 1
+                            verified_names.add(clip_base_name(filename))
+
+            logging.info(f"Successfully uploaded {successful_uploads}/{len(existing_files)} files "
+                         f"({verified_uploads} verified)")
+
+            # Step 5: Format each Ki Pro whose clips all verified, returning every
+            # unit to Record-Play mode as soon as it is done. Only Ki Pro 3 is
+            # downloaded from, so it is the only unit with verified clips.
+            results = self.format_kipro_media({3: verified_names})
+
+            # Step 6: Proxies work from the local copies, so only wait for them
+            # once the units are back in Record-Play, then clean up
+            if proxy_stage:
+                proxy_stage.finish()
+                proxy_stage = None
             self.cleanup_local_files()
-            
-            # Step 6: Format Ki Pro media (only if uploads were successful)
-            if successful_uploads == len(existing_files):
-                logging.info("All files uploaded successfully, formatting Ki Pro media...")
-                self.format_kipro_media()
-                time.sleep(10)  # Wait for format to complete
-            else:
-                logging.warning("Some uploads failed, skipping format")
-            
-            # Step 7: Return Ki Pro to Record-Play mode
-            self.set_kipro_data_mode(False)
-            
+
             logging.info("=== Weekly upload completed ===")
-            return True
+            return all(r["status"] in ("formatted", "skipped") for r in results.values())
             
         except Exception as e:
             logging.error(f"Upload failed with error: {e}")
             # Try to return to Record-Play mode
             self.set_kipro_data_mode(False)
+            if proxy_stage:
+                proxy_stage.abort()
+            self.cleanup_local_files()
             return False
 
 def main():
@@ -644,6 +1123,9 @@ def main():
     schedule.every().sunday.at("09:55").do(automation.stop_all_recordings)
     schedule.every().sunday.at("11:55").do(automation.stop_all_recordings)
 
+    # Weekly Dropbox retention/compaction after the upload (dry run unless RETENTION_DRY_RUN = False)
+    schedule.every().sunday.at("04:00").do(automation.run_retention)
+
     # Alternative scheduling options:
     # schedule.every().monday.at("02:00").do(automation.run_weekly_upload)  # Every Monday
     # schedule.every(7).days.at("02:00").do(automation.run_weekly_upload)   # Every 7 days
@@ -652,6 +1134,7 @@ def main():
     logging.info("Weekly upload scheduled for Sundays at 2:00 AM")
     logging.info("Automatic recordings scheduled for Sundays at 8:55 AM and 10:55 AM")
     logging.info("Automatic recording stops scheduled for Sundays at 9:55 AM and 11:55 AM")
+    logging.info("Dropbox retention scheduled for Sundays at 4:00 AM")
     
     # Keep the script running
     while True:
@@ -691,6 +1174,10 @@ if __name__ == "__main__":
         # Test upload
         # print("\nTesting upload...")
         # automation.run_weekly_upload()
+
+        # Preview Dropbox retention (dry run)
+        # print("\nTesting retention...")
+        # automation.run_retention(dry_run=True)
         
         print("\nTest completed. Check the log file for detailed results.")
         print("To run the scheduler, uncomment the main() call below.")